@@ -2,74 +2,492 @@ import torch
 import torch.nn as nn
 import torch.nn.functional as F
 import numpy as np
-from functools import partial
+from functools import lru_cache, partial
 from timm.models.layers import DropPath, to_2tuple, trunc_normal_
 from timm.models import register_model
 from timm.models.vision_transformer import _cfg
 import math
+import contextlib
+
+try:
+    import triton
+    import triton.language as tl
+except ImportError:
+    triton = None
+
+
+def use_triton(x):
+    return triton is not None and x.is_cuda and not torch.is_grad_enabled()
+
+
+if triton is not None:
+    @triton.jit
+    def _local_window_attn_kernel(
+            q_ptr, qn_ptr, k_ptr, v_ptr, rpb_ptr, lt_ptr, lb_ptr, m_ptr, l_ptr, acc_ptr, out_ptr,
+            num_heads, N, H, W, D,
+            s_qb, s_qh, s_qn, s_qd,
+            s_nb, s_nh, s_nn, s_nd,
+            s_kb, s_kh, s_kd, s_ky, s_kx,
+            s_vb, s_vh, s_vd, s_vy, s_vx,
+            s_mb, s_mh, s_mn,
+            s_ab, s_ah, s_an, s_ad,
+            s_ob, s_oh, s_on, s_od,
+            WINDOW: tl.constexpr, BLOCK_N: tl.constexpr, BLOCK_D: tl.constexpr):
+        pid_n = tl.program_id(0)
+        pid_bh = tl.program_id(1)
+        b = pid_bh // num_heads
+        h = pid_bh % num_heads
+
+        offs_n = pid_n * BLOCK_N + tl.arange(0, BLOCK_N)
+        offs_d = tl.arange(0, BLOCK_D)
+        mask_n = offs_n < N
+        mask_d = offs_d < D
+        mask_nd = mask_n[:, None] & mask_d[None, :]
+        row = offs_n // W
+        col = offs_n % W
+
+        q = tl.load(q_ptr + b * s_qb + h * s_qh + offs_n[:, None] * s_qn + offs_d[None, :] * s_qd,
+                    mask=mask_nd, other=0.).to(tl.float32)
+        qn = tl.load(qn_ptr + b * s_nb + h * s_nh + offs_n[:, None] * s_nn + offs_d[None, :] * s_nd,
+                     mask=mask_nd, other=0.).to(tl.float32)
+
+        # finite initial max so that fully padded leading offsets do not produce inf - inf
+        m_i = tl.full([BLOCK_N], -1e30, dtype=tl.float32)
+        l_i = tl.zeros([BLOCK_N], dtype=tl.float32)
+        acc = tl.zeros([BLOCK_N, BLOCK_D], dtype=tl.float32)
+        acc_lt = tl.zeros([BLOCK_N, BLOCK_D], dtype=tl.float32)
+
+        for i in tl.static_range(WINDOW):
+            for j in tl.static_range(WINDOW):
+                y = row + i - WINDOW // 2
+                x = col + j - WINDOW // 2
+                valid = mask_n & (y >= 0) & (y < H) & (x >= 0) & (x < W)
+                mask_kv = valid[:, None] & mask_d[None, :]
+                k = tl.load(k_ptr + b * s_kb + h * s_kh + offs_d[None, :] * s_kd + y[:, None] * s_ky + x[:, None] * s_kx,
+                            mask=mask_kv, other=0.).to(tl.float32)
+                v = tl.load(v_ptr + b * s_vb + h * s_vh + offs_d[None, :] * s_vd + y[:, None] * s_vy + x[:, None] * s_vx,
+                            mask=mask_kv, other=0.).to(tl.float32)
+
+                s = tl.sum(q * k, axis=1) + tl.load(rpb_ptr + h * WINDOW * WINDOW + i * WINDOW + j).to(tl.float32)
+                s = tl.where(valid, s, float('-inf'))
+                m_new = tl.maximum(m_i, s)
+                alpha = tl.exp(m_i - m_new)
+                p = tl.exp(s - m_new)
+                l_i = l_i * alpha + p
+                acc = acc * alpha[:, None] + p[:, None] * v
+                m_i = m_new
+
+                lt = tl.load(lt_ptr + h * D * WINDOW * WINDOW + offs_d * WINDOW * WINDOW + i * WINDOW + j,
+                             mask=mask_d, other=0.).to(tl.float32)
+                w_lt = tl.sum(qn * lt[None, :], axis=1) + tl.load(lb_ptr + h * WINDOW * WINDOW + i * WINDOW + j).to(tl.float32)
+                acc_lt += w_lt[:, None] * v
+
+        # the softmax is joint with the pool keys: export the unnormalized state, normalized in the pool kernel
+        tl.store(m_ptr + b * s_mb + h * s_mh + offs_n * s_mn, m_i, mask=mask_n)
+        tl.store(l_ptr + b * s_mb + h * s_mh + offs_n * s_mn, l_i, mask=mask_n)
+        tl.store(acc_ptr + b * s_ab + h * s_ah + offs_n[:, None] * s_an + offs_d[None, :] * s_ad, acc, mask=mask_nd)
+        tl.store(out_ptr + b * s_ob + h * s_oh + offs_n[:, None] * s_on + offs_d[None, :] * s_od,
+                 acc_lt.to(out_ptr.dtype.element_ty), mask=mask_nd)
+
+    @triton.jit
+    def _pool_attn_kernel(
+            q_ptr, k_ptr, kinv_ptr, v_ptr, bias_ptr, m_ptr, l_ptr, acc_ptr, out_ptr,
+            num_heads, N, P, D,
+            s_qb, s_qh, s_qn, s_qd,
+            s_kb, s_kh, s_kp, s_kd,
+            s_ib, s_ih, s_ip,
+            s_vb, s_vh, s_vp, s_vd,
+            s_bh, s_bn, s_bp,
+            s_mb, s_mh, s_mn,
+            s_ab, s_ah, s_an, s_ad,
+            s_ob, s_oh, s_on, s_od,
+            INPUT_PRECISION: tl.constexpr,
+            BLOCK_N: tl.constexpr, BLOCK_P: tl.constexpr, BLOCK_D: tl.constexpr):
+        pid_n = tl.program_id(0)
+        pid_bh = tl.program_id(1)
+        b = pid_bh // num_heads
+        h = pid_bh % num_heads
+
+        offs_n = pid_n * BLOCK_N + tl.arange(0, BLOCK_N)
+        offs_d = tl.arange(0, BLOCK_D)
+        mask_n = offs_n < N
+        mask_d = offs_d < D
+        mask_nd = mask_n[:, None] & mask_d[None, :]
+
+        q = tl.load(q_ptr + b * s_qb + h * s_qh + offs_n[:, None] * s_qn + offs_d[None, :] * s_qd,
+                    mask=mask_nd, other=0.).to(tl.float32)
+        m_i = tl.load(m_ptr + b * s_mb + h * s_mh + offs_n * s_mn, mask=mask_n, other=0.)
+        l_i = tl.load(l_ptr + b * s_mb + h * s_mh + offs_n * s_mn, mask=mask_n, other=1.)
+        acc = tl.load(acc_ptr + b * s_ab + h * s_ah + offs_n[:, None] * s_an + offs_d[None, :] * s_ad,
+                      mask=mask_nd, other=0.)
+
+        for start in range(0, P, BLOCK_P):
+            offs_p = start + tl.arange(0, BLOCK_P)
+            mask_p = offs_p < P
+            mask_pd = mask_p[:, None] & mask_d[None, :]
+            k = tl.load(k_ptr + b * s_kb + h * s_kh + offs_p[:, None] * s_kp + offs_d[None, :] * s_kd,
+                        mask=mask_pd, other=0.).to(tl.float32)
+            v = tl.load(v_ptr + b * s_vb + h * s_vh + offs_p[:, None] * s_vp + offs_d[None, :] * s_vd,
+                        mask=mask_pd, other=0.).to(tl.float32)
+            k_inv = tl.load(kinv_ptr + b * s_ib + h * s_ih + offs_p * s_ip, mask=mask_p, other=0.).to(tl.float32)
+            bias = tl.load(bias_ptr + h * s_bh + offs_n[:, None] * s_bn + offs_p[None, :] * s_bp,
+                           mask=mask_n[:, None] & mask_p[None, :], other=0.).to(tl.float32)
+
+            s = tl.dot(q, tl.trans(k), input_precision=INPUT_PRECISION) * k_inv[None, :] + bias
+            s = tl.where(mask_p[None, :], s, float('-inf'))
+            m_new = tl.maximum(m_i, tl.max(s, axis=1))
+            alpha = tl.exp(m_i - m_new)
+            p = tl.exp(s - m_new[:, None])
+            l_i = l_i * alpha + tl.sum(p, axis=1)
+            acc = acc * alpha[:, None] + tl.dot(p, v, input_precision=INPUT_PRECISION)
+            m_i = m_new
+
+        out_ptrs = out_ptr + b * s_ob + h * s_oh + offs_n[:, None] * s_on + offs_d[None, :] * s_od
+        out = tl.load(out_ptrs, mask=mask_nd, other=0.).to(tl.float32) + acc / l_i[:, None]
+        tl.store(out_ptrs, out.to(out_ptr.dtype.element_ty), mask=mask_nd)
+
+    @triton.jit
+    def _query_prelude_kernel(
+            q_ptr, qe_ptr, t_ptr, scale_ptr, qn_ptr, qs_ptr,
+            num_heads, N, D,
+            s_qb, s_qh, s_qn, s_qd, s_scale,
+            STORE_NORM: tl.constexpr, BLOCK_N: tl.constexpr, BLOCK_D: tl.constexpr):
+        pid_n = tl.program_id(0)
+        pid_bh = tl.program_id(1)
+        b = pid_bh // num_heads
+        h = pid_bh % num_heads
+
+        offs_n = pid_n * BLOCK_N + tl.arange(0, BLOCK_N)
+        offs_d = tl.arange(0, BLOCK_D)
+        mask_n = offs_n < N
+        mask_d = offs_d < D
+        mask_nd = mask_n[:, None] & mask_d[None, :]
+
+        q = tl.load(q_ptr + b * s_qb + h * s_qh + offs_n[:, None] * s_qn + offs_d[None, :] * s_qd,
+                    mask=mask_nd, other=0.).to(tl.float32)
+        q = q / tl.maximum(tl.sqrt(tl.sum(q * q, axis=1)), 1e-12)[:, None]
+        out_offs = (pid_bh * N + offs_n[:, None]) * D + offs_d[None, :]
+        if STORE_NORM:
+            tl.store(qn_ptr + out_offs, q.to(qn_ptr.dtype.element_ty), mask=mask_nd)
+
+        t = tl.load(t_ptr + h).to(tl.float32)
+        t = tl.where(t > 20., t, tl.log(1. + tl.exp(t)))
+        qe = tl.load(qe_ptr + h * D + offs_d, mask=mask_d, other=0.).to(tl.float32)
+        scale = tl.load(scale_ptr + offs_n * s_scale, mask=mask_n, other=0.).to(tl.float32)
+        q = (q + qe[None, :]) * (t * scale)[:, None]
+        tl.store(qs_ptr + out_offs, q.to(qs_ptr.dtype.element_ty), mask=mask_nd)
+
+    @triton.jit
+    def _add_layernorm_kernel(
+            x_ptr, r_ptr, w_ptr, b_ptr, res_ptr, out_ptr,
+            C, eps,
+            s_xn, s_xc, s_rn, s_rc,
+            BLOCK_C: tl.constexpr):
+        row = tl.program_id(0)
+        offs = tl.arange(0, BLOCK_C)
+        mask = offs < C
+
+        x = tl.load(x_ptr + row * s_xn + offs * s_xc, mask=mask, other=0.).to(tl.float32) \
+            + tl.load(r_ptr + row * s_rn + offs * s_rc, mask=mask, other=0.).to(tl.float32)
+        tl.store(res_ptr + row * C + offs, x.to(res_ptr.dtype.element_ty), mask=mask)
+
+        mean = tl.sum(x, axis=0) / C
+        xc = tl.where(mask, x - mean, 0.)
+        var = tl.sum(xc * xc, axis=0) / C
+        w = tl.load(w_ptr + offs, mask=mask, other=0.).to(tl.float32)
+        b = tl.load(b_ptr + offs, mask=mask, other=0.).to(tl.float32)
+        y = xc * tl.rsqrt(var + eps) * w + b
+        tl.store(out_ptr + row * C + offs, y.to(out_ptr.dtype.element_ty), mask=mask)
+
+    @triton.jit
+    def _dwconv3x3_kernel(
+            x_ptr, w_ptr, b_ptr, g_ptr, out_ptr,
+            N, C, H, W,
+            s_xb, s_xn, s_xc,
+            s_gb, s_gn, s_gc,
+            s_ob, s_on, s_oc,
+            GATE: tl.constexpr, BLOCK_N: tl.constexpr, BLOCK_C: tl.constexpr):
+        pid_n = tl.program_id(0)
+        pid_c = tl.program_id(1)
+        b = tl.program_id(2)
+
+        offs_n = pid_n * BLOCK_N + tl.arange(0, BLOCK_N)
+        offs_c = pid_c * BLOCK_C + tl.arange(0, BLOCK_C)
+        mask_n = offs_n < N
+        mask_c = offs_c < C
+        row = offs_n // W
+        col = offs_n % W
+
+        acc = tl.zeros([BLOCK_N, BLOCK_C], dtype=tl.float32)
+        for i in tl.static_range(3):
+            for j in tl.static_range(3):
+                y = row + i - 1
+                x = col + j - 1
+                valid = mask_n & (y >= 0) & (y < H) & (x >= 0) & (x < W)
+                xv = tl.load(x_ptr + b * s_xb + (y * W + x)[:, None] * s_xn + offs_c[None, :] * s_xc,
+                             mask=valid[:, None] & mask_c[None, :], other=0.).to(tl.float32)
+                w = tl.load(w_ptr + offs_c * 9 + i * 3 + j, mask=mask_c, other=0.).to(tl.float32)
+                acc += xv * w[None, :]
+        acc += tl.load(b_ptr + offs_c, mask=mask_c, other=0.).to(tl.float32)[None, :]
+
+        mask_nc = mask_n[:, None] & mask_c[None, :]
+        if GATE:
+            # ConvolutionalGLU epilogue: exact GELU times the value half
+            g = tl.load(g_ptr + b * s_gb + offs_n[:, None] * s_gn + offs_c[None, :] * s_gc,
+                        mask=mask_nc, other=0.).to(tl.float32)
+            acc = 0.5 * acc * (1. + tl.math.erf(acc * 0.7071067811865476)) * g
+        tl.store(out_ptr + b * s_ob + offs_n[:, None] * s_on + offs_c[None, :] * s_oc,
+                 acc.to(out_ptr.dtype.element_ty), mask=mask_nc)
+
+
+def local_window_attn_triton(q_norm, q_norm_scaled, k_local, v_local, relative_pos_bias_local,
+                             learnable_tokens, learnable_bias):
+    # q_*: (B, num_heads, N, head_dim); k_local, v_local: (B, num_heads, head_dim, H, W)
+    # returns the learnable-token term and the online-softmax state (m, l, acc) of the local keys
+    B, num_heads, N, D = q_norm_scaled.shape
+    H, W = k_local.shape[-2:]
+    window_size = math.isqrt(relative_pos_bias_local.shape[-1])
+    out = torch.empty(B, N, num_heads, D, device=v_local.device, dtype=v_local.dtype).permute(0, 2, 1, 3)
+    m = torch.empty(B, num_heads, N, device=v_local.device, dtype=torch.float32)
+    l = torch.empty_like(m)
+    acc = torch.empty(B, num_heads, N, D, device=v_local.device, dtype=torch.float32)
+    BLOCK_N = 32
+    grid = (triton.cdiv(N, BLOCK_N), B * num_heads)
+    _local_window_attn_kernel[grid](
+        q_norm_scaled, q_norm, k_local, v_local, relative_pos_bias_local.contiguous(),
+        learnable_tokens.contiguous(), learnable_bias.contiguous(), m, l, acc, out,
+        num_heads, N, H, W, D,
+        *q_norm_scaled.stride(), *q_norm.stride(), *k_local.stride(), *v_local.stride(),
+        *m.stride(), *acc.stride(), *out.stride(),
+        WINDOW=window_size, BLOCK_N=BLOCK_N, BLOCK_D=triton.next_power_of_2(D))
+    return out, m, l, acc
+
+
+def pool_attn_triton(q_norm_scaled, k_pool, k_pool_inv, v_pool, pool_bias, m, l, acc, out):
+    # continues the local online softmax over the pooled keys and adds the normalized result to out in place;
+    # k_pool is unnormalized, its inverse norms (B, num_heads, pool_len, 1) scale the score columns.
+    # The dots run on fp32 operands; like torch.matmul they only use TF32 when allow_tf32 is set, the logit
+    # scale (~18 at init) would otherwise amplify the TF32 rounding of q.k
+    B, num_heads, N, D = q_norm_scaled.shape
+    P = k_pool.shape[-2]
+    BLOCK_N, BLOCK_P = 32, 32
+    grid = (triton.cdiv(N, BLOCK_N), B * num_heads)
+    _pool_attn_kernel[grid](
+        q_norm_scaled, k_pool, k_pool_inv, v_pool, pool_bias, m, l, acc, out,
+        num_heads, N, P, D,
+        *q_norm_scaled.stride(), *k_pool.stride(), *k_pool_inv.stride()[:3], *v_pool.stride(), *pool_bias.stride(),
+        *m.stride(), *acc.stride(), *out.stride(),
+        INPUT_PRECISION="tf32" if torch.backends.cuda.matmul.allow_tf32 else "ieee",
+        BLOCK_N=BLOCK_N, BLOCK_P=BLOCK_P, BLOCK_D=max(triton.next_power_of_2(D), 16))
+    return out
+
+
+def query_prelude(q, query_embedding, temperature, seq_length_scale, return_norm=False):
+    # (F.normalize(q) + query_embedding) * softplus(temperature) * seq_length_scale, as one kernel on the
+    # triton path; q: (B, num_heads, N, head_dim), seq_length_scale: scalar or one value per query
+    if not use_triton(q):
+        q_norm = F.normalize(q, dim=-1)
+        q_norm_scaled = (q_norm + query_embedding) * F.softplus(temperature) * seq_length_scale
+        return (q_norm, q_norm_scaled) if return_norm else q_norm_scaled
+
+    B, num_heads, N, D = q.shape
+    q_norm_scaled = torch.empty(B, num_heads, N, D, device=q.device, dtype=q.dtype)
+    q_norm = torch.empty_like(q_norm_scaled) if return_norm else q_norm_scaled
+    seq_length_scale = seq_length_scale.reshape(-1).expand(N)
+    BLOCK_N = 32
+    grid = (triton.cdiv(N, BLOCK_N), B * num_heads)
+    _query_prelude_kernel[grid](
+        q, query_embedding.contiguous(), temperature.contiguous(), seq_length_scale, q_norm, q_norm_scaled,
+        num_heads, N, D,
+        *q.stride(), seq_length_scale.stride(0),
+        STORE_NORM=return_norm, BLOCK_N=BLOCK_N, BLOCK_D=triton.next_power_of_2(D))
+    return (q_norm, q_norm_scaled) if return_norm else q_norm_scaled
+
+
+def add_layernorm_triton(x, residual, weight, bias, eps):
+    # residual + x and layer_norm(residual + x) in one pass over each row; returns (normalized, new residual).
+    # The inputs may be strided (e.g. tokens transposed from NCHW), the outputs are contiguous.
+    C = x.shape[-1]
+    x2d = x.reshape(-1, C)
+    r2d = residual.reshape(-1, C)
+    dtype = torch.promote_types(x.dtype, residual.dtype)
+    new_residual = torch.empty(residual.shape, device=x.device, dtype=dtype)
+    out = torch.empty_like(new_residual)
+    _add_layernorm_kernel[(x2d.shape[0],)](
+        x2d, r2d, weight, bias, new_residual, out,
+        C, eps,
+        *x2d.stride(), *r2d.stride(),
+        BLOCK_C=triton.next_power_of_2(C))
+    return out, new_residual
+
+
+def dwconv3x3_triton(x, weight, bias, H, W, gate=None):
+    # depthwise 3x3 (padding 1) straight on the (B, N, C) token layout, no NCHW round trip;
+    # with gate, returns gelu(dwconv(x)) * gate
+    B, N, C = x.shape
+    out = torch.empty(B, N, C, device=x.device, dtype=x.dtype)
+    g = x if gate is None else gate
+    BLOCK_N, BLOCK_C = 32, 64
+    grid = (triton.cdiv(N, BLOCK_N), triton.cdiv(C, BLOCK_C), B)
+    _dwconv3x3_kernel[grid](
+        x, weight.reshape(C, 9).contiguous(), bias, g, out,
+        N, C, H, W,
+        *x.stride(), *g.stride(), *out.stride(),
+        GATE=gate is not None, BLOCK_N=BLOCK_N, BLOCK_C=BLOCK_C)
+    return out
+
+
+def dwconv3x3_taps(x, weight, bias):
+    # depthwise 3x3 (padding 1) as nine shifted multiply-adds, bypassing the grouped-conv code path;
+    # x: (B, C, H, W), weight: (C, 1, 3, 3) as in nn.Conv2d(C, C, 3, padding=1, groups=C)
+    H, W = x.shape[-2:]
+    x = F.pad(x, (1, 1, 1, 1))
+    out = bias.view(-1, 1, 1)
+    for i in range(3):
+        for j in range(3):
+            out = out + weight[:, 0, i, j].view(-1, 1, 1) * x[..., i:i + H, j:j + W]
+    return out
+
+
+@lru_cache()
+def dwconv3x3_taps_compiled():
+    # inductor fuses the nine taps into a single kernel; built on first use so that importing this module
+    # does not depend on torch.compile being supported
+    return torch.compile(dwconv3x3_taps, dynamic=False)
 
 
 class DWConv(nn.Module):
-    def __init__(self, dim=768):
+    def __init__(self, dim=768, tap_sum=False):
         super(DWConv, self).__init__()
         self.dwconv = nn.Conv2d(dim, dim, kernel_size=3, stride=1, padding=1, bias=True, groups=dim)
+        self.tap_sum = tap_sum
 
     def forward(self, x, H, W):
+        if use_triton(x):
+            return dwconv3x3_triton(x, self.dwconv.weight, self.dwconv.bias, H, W)
         B, N, C = x.shape
-        x = x.transpose(1, 2).view(B, C, H, W).contiguous()
-        x = self.dwconv(x)
+        # (B, N, C) is already NHWC: hand the conv a channels_last view instead of an NCHW copy
+        x = x.view(B, H, W, C).permute(0, 3, 1, 2)
+        if self.tap_sum:
+            x = dwconv3x3_taps_compiled()(x, self.dwconv.weight, self.dwconv.bias)
+        else:
+            x = self.dwconv(x)
         x = x.flatten(2).transpose(1, 2)
 
         return x
 
 
 class ConvolutionalGLU(nn.Module):
-    def __init__(self, in_features, hidden_features=None, out_features=None, act_layer=nn.GELU, drop=0.):
+    def __init__(self, in_features, hidden_features=None, out_features=None, act_layer=nn.GELU, drop=0.,
+                 dw_tap_sum=False):
         super().__init__()
         out_features = out_features or in_features
         hidden_features = hidden_features or in_features
         hidden_features = int(2 * hidden_features / 3)
         self.fc1 = nn.Linear(in_features, hidden_features * 2)
-        self.dwconv = DWConv(hidden_features)
+        self.dwconv = DWConv(hidden_features, tap_sum=dw_tap_sum)
         self.act = act_layer()
         self.fc2 = nn.Linear(hidden_features, out_features)
-        self.drop = nn.Dropout(drop)
+        self.drop = nn.Dropout(drop) if drop > 0. else nn.Identity()
 
     def forward(self, x, H, W):
         x, v = self.fc1(x).chunk(2, dim=-1)
-        x = self.act(self.dwconv(x, H, W)) * v
+        if use_triton(x) and isinstance(self.act, nn.GELU) and self.act.approximate == 'none':
+            # chunk is a strided view, the kernel reads both halves of the fc1 output in place
+            x = dwconv3x3_triton(x, self.dwconv.dwconv.weight, self.dwconv.dwconv.bias, H, W, gate=v)
+        else:
+            x = self.act(self.dwconv(x, H, W)) * v
         x = self.drop(x)
         x = self.fc2(x)
         x = self.drop(x)
         return x
 
 
-@torch.no_grad()
-def get_relative_position_cpb(query_size, key_size, pretrain_size=None):
-    device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
-    pretrain_size = pretrain_size or query_size
-    axis_qh = torch.arange(query_size[0], dtype=torch.float32, device=device)
-    axis_kh = F.adaptive_avg_pool1d(axis_qh.unsqueeze(0), key_size[0]).squeeze(0)
-    axis_qw = torch.arange(query_size[1], dtype=torch.float32, device=device)
-    axis_kw = F.adaptive_avg_pool1d(axis_qw.unsqueeze(0), key_size[1]).squeeze(0)
-    axis_kh, axis_kw = torch.meshgrid(axis_kh, axis_kw)
-    axis_qh, axis_qw = torch.meshgrid(axis_qh, axis_qw)
-
-    axis_kh = torch.reshape(axis_kh, [-1])
-    axis_kw = torch.reshape(axis_kw, [-1])
-    axis_qh = torch.reshape(axis_qh, [-1])
-    axis_qw = torch.reshape(axis_qw, [-1])
+def _adaptive_avg_pool1d_np(x, output_size):
+    # same bins as F.adaptive_avg_pool1d: [floor(i * L / out), ceil((i + 1) * L / out))
+    length = x.shape[0]
+    start = np.arange(output_size) * length // output_size
+    end = -(-(np.arange(output_size) + 1) * length // output_size)
+    return np.array([x[s:e].mean() for s, e in zip(start, end)], dtype=np.float32)
+
 
+@lru_cache()
+def _relative_position_cpb_np(query_size, key_size, pretrain_size):
+    axis_qh = np.arange(query_size[0], dtype=np.float32)
+    axis_kh = _adaptive_avg_pool1d_np(axis_qh, key_size[0])
+    axis_qw = np.arange(query_size[1], dtype=np.float32)
+    axis_kw = _adaptive_avg_pool1d_np(axis_qw, key_size[1])
+
+    # h and w offsets are independent and every (h, w) pair occurs, so the unique (h, w) rows are the
+    # cartesian product of the per-axis unique values in lexicographic order and the inverse index is
+    # idx_h * len(w) + idx_w; no sort over all Q * K coordinate pairs
     relative_h = (axis_qh[:, None] - axis_kh[None, :]) / (pretrain_size[0] - 1) * 8
     relative_w = (axis_qw[:, None] - axis_kw[None, :]) / (pretrain_size[1] - 1) * 8
-    relative_hw = torch.stack([relative_h, relative_w], dim=-1).view(-1, 2)
+    unique_h = np.unique(relative_h)
+    unique_w = np.unique(relative_w)
+    idx_h = np.searchsorted(unique_h, relative_h)
+    idx_w = np.searchsorted(unique_w, relative_w)
+
+    idx_map = (idx_h[:, None, :, None] * len(unique_w) + idx_w[None, :, None, :]).reshape(
+        len(axis_qh) * len(axis_qw), len(axis_kh) * len(axis_kw))
+    relative_coords_table = np.stack(np.meshgrid(unique_h, unique_w, indexing='ij'), axis=-1).reshape(-1, 2)
+
+    relative_coords_table = np.sign(relative_coords_table) * np.log2(
+        np.abs(relative_coords_table) + 1.0) / np.log2(np.float32(8))
+
+    idx_map = idx_map.astype(np.int64)
+    relative_coords_table = relative_coords_table.astype(np.float32)
+    # shared between every model built with the same sizes
+    idx_map.setflags(write=False)
+    relative_coords_table.setflags(write=False)
+    return idx_map, relative_coords_table
+
 
-    relative_coords_table, idx_map = torch.unique(relative_hw, return_inverse=True, dim=0)
+def get_relative_position_cpb(query_size, key_size, pretrain_size=None):
+    # built on the CPU with NumPy; register_buffer + .to(device) moves it later
+    pretrain_size = pretrain_size or query_size
+    idx_map, relative_coords_table = _relative_position_cpb_np(tuple(query_size), tuple(key_size),
+                                                               tuple(pretrain_size))
+    return torch.tensor(idx_map, dtype=torch.long), torch.tensor(relative_coords_table)
+
+
+def cpb_cache_key(attns, relative_coords_table):
+    # identifies the cpb weights of attns by storage and version counter. Writes through .data do not bump
+    # _version, so the caches built on this key are also dropped on every train()/eval() switch.
+    return (relative_coords_table.data_ptr(),) + tuple(
+        (p.data_ptr(), p._version) for attn in attns
+        for m in (attn.cpb_fc1, attn.cpb_fc2) for p in m.parameters())
+
+
+def cpb_bias_table(attn, relative_coords_table):
+    # (num_coords, num_heads) output of the cpb MLP. Outside training it is a constant, kept in the module's
+    # cpb_bias_table buffer and recomputed only when a cpb parameter is updated or moved.
+    if attn.training or torch.is_grad_enabled():
+        return attn.cpb_fc2(attn.cpb_act(attn.cpb_fc1(relative_coords_table)))
+    key = cpb_cache_key([attn], relative_coords_table)
+    if attn.cpb_bias_table is None or attn._cpb_bias_key != key:
+        attn.cpb_bias_table = attn.cpb_fc2(attn.cpb_act(attn.cpb_fc1(relative_coords_table)))
+        attn._cpb_bias_key = key
+    return attn.cpb_bias_table
+
+
+def relative_position_bias(attn, relative_pos_index, relative_coords_table):
+    # gathers the cpb table of attn into the (num_heads, N, num_keys) bias
+    return cpb_bias_table(attn, relative_coords_table).transpose(0, 1)[:,
+           relative_pos_index.view(-1)].view(-1, *relative_pos_index.shape)
+
+
+def local_window_view(x, window_size):
+    # (..., H, W) -> (..., H, W, window_size, window_size) strided view over the zero-padded input;
+    # same neighbourhoods as nn.Unfold(window_size, padding=window_size // 2) without the K^2 copy
+    pad = window_size // 2
+    x = F.pad(x, (pad, pad, pad, pad))
+    *batch, H, W = x.shape
+    stride_h, stride_w = x.stride()[-2:]
+    return x.as_strided((*batch, H - 2 * pad, W - 2 * pad, window_size, window_size),
+                        (*x.stride()[:-2], stride_h, stride_w, stride_h, stride_w))
 
-    relative_coords_table = torch.sign(relative_coords_table) * torch.log2(
-        torch.abs(relative_coords_table) + 1.0) / torch.log2(torch.tensor(8, dtype=torch.float32))
 
-    return idx_map, relative_coords_table
 @torch.no_grad()
 def get_seqlen_and_mask(input_resolution, window_size):
     attn_map = F.unfold(torch.ones([1, 1, input_resolution[0], input_resolution[1]]), window_size,
@@ -97,16 +515,15 @@ class AggregatedAttention(nn.Module):
         self.pool_H, self.pool_W = input_resolution[0] // self.sr_ratio, input_resolution[1] // self.sr_ratio
         self.pool_len = self.pool_H * self.pool_W
 
-        self.unfold = nn.Unfold(kernel_size=window_size, padding=window_size // 2, stride=1)
         self.temperature = nn.Parameter(torch.log((torch.ones(num_heads, 1, 1) / 0.24).exp() - 1))
 
         self.q = nn.Linear(dim, dim, bias=qkv_bias)
         self.query_embedding = nn.Parameter(
             nn.init.trunc_normal_(torch.empty(self.num_heads, 1, self.head_dim), mean=0, std=0.02))
         self.kv = nn.Linear(dim, dim * 2, bias=qkv_bias)
-        self.attn_drop = nn.Dropout(attn_drop)
+        self.attn_drop = nn.Dropout(attn_drop) if attn_drop > 0. else nn.Identity()
         self.proj = nn.Linear(dim, dim)
-        self.proj_drop = nn.Dropout(proj_drop)
+        self.proj_drop = nn.Dropout(proj_drop) if proj_drop > 0. else nn.Identity()
 
 
         self.pool = nn.AdaptiveAvgPool2d((self.pool_H, self.pool_W))
@@ -118,6 +535,8 @@ class AggregatedAttention(nn.Module):
         self.cpb_fc1 = nn.Linear(2, 512, bias=True)
         self.cpb_act = nn.ReLU(inplace=True)
         self.cpb_fc2 = nn.Linear(512, num_heads, bias=True)
+        self.register_buffer("cpb_bias_table", None, persistent=False)
+        self._cpb_bias_key = None
 
 
         self.relative_pos_bias_local = nn.Parameter(
@@ -135,48 +554,67 @@ class AggregatedAttention(nn.Module):
             nn.init.trunc_normal_(torch.empty(num_heads, self.head_dim, self.local_len), mean=0, std=0.02))
         self.learnable_bias = nn.Parameter(torch.zeros(num_heads, 1, self.local_len))
 
-    def forward(self, x, H, W, relative_pos_index, relative_coords_table):
+    def forward(self, x, H, W, relative_pos_bias):
         B, N, C = x.shape
 
 
-        q_norm=F.normalize(self.q(x).reshape(B, N, self.num_heads, self.head_dim).permute(0, 2, 1, 3),dim=-1)
-        q_norm_scaled = (q_norm + self.query_embedding) * F.softplus(self.temperature) * self.seq_length_scale
+        q_norm, q_norm_scaled = query_prelude(self.q(x).reshape(B, N, self.num_heads, self.head_dim).permute(0, 2, 1, 3),
+                                              self.query_embedding, self.temperature, self.seq_length_scale,
+                                              return_norm=True)
 
 
-        k_local, v_local = self.kv(x).chunk(2, dim=-1)
-        k_local = F.normalize(k_local.reshape(B, N, self.num_heads, self.head_dim), dim=-1).reshape(B, N, -1)
-        kv_local = torch.cat([k_local, v_local], dim=-1).permute(0, 2, 1).reshape(B, -1, H, W)
-        k_local, v_local = self.unfold(kv_local).reshape(
-            B, 2 * self.num_heads, self.head_dim, self.local_len, N).permute(0, 1, 4, 2, 3).chunk(2, dim=1)
+        x_ = x.reshape(B, H, W, C).permute(0, 3, 1, 2)
+        x_ = self.pool(self.act(self.sr(x_))).reshape(B, -1, self.pool_len).permute(0, 2, 1)
+        x_ = self.norm(x_)
 
 
-        attn_local = ((q_norm_scaled.unsqueeze(-2) @ k_local).squeeze(-2) \
-                      + self.relative_pos_bias_local.unsqueeze(1)).masked_fill(self.padding_mask, float('-inf'))
+        # one kv GEMM over [tokens | pooled tokens] instead of two
+        kv_local, kv_pool = self.kv(torch.cat([x, x_], dim=1)).split([N, self.pool_len], dim=1)
+        kv_pool = kv_pool.reshape(B, self.pool_len, 2 * self.num_heads, self.head_dim).permute(0, 2, 1, 3)
+        k_pool, v_pool = kv_pool.chunk(2, dim=1)
+        # q_norm_scaled @ F.normalize(k_pool).T == (q_norm_scaled @ k_pool.T) / ||k_pool||, column-wise: the
+        # triton kernel scales its score tile, the eager path scales the (pool_len, head_dim) keys
+        k_pool_inv = torch.rsqrt((k_pool * k_pool).sum(dim=-1, keepdim=True, dtype=torch.float32).clamp_min(1e-24))
 
 
-        x_ = x.permute(0, 2, 1).reshape(B, -1, H, W).contiguous()
-        x_ = self.pool(self.act(self.sr(x_))).reshape(B, -1, self.pool_len).permute(0, 2, 1)
-        x_ = self.norm(x_)
+        # (B, num_heads, head_dim, H, W) image views over the token-major kv projection
+        k_local, v_local = kv_local.reshape(B, N, 2, self.num_heads, self.head_dim).unbind(2)
+        k_local = F.normalize(k_local, dim=-1).permute(0, 2, 3, 1).unflatten(-1, (H, W))
+        v_local = v_local.permute(0, 2, 3, 1).unflatten(-1, (H, W))
 
 
-        kv_pool = self.kv(x_).reshape(B, self.pool_len, 2 * self.num_heads, self.head_dim).permute(0, 2, 1, 3)
-        k_pool, v_pool = kv_pool.chunk(2, dim=1)
+        if use_triton(x) and not (self.training and isinstance(self.attn_drop, nn.Dropout)):
+            x, m, l, acc = local_window_attn_triton(q_norm, q_norm_scaled, k_local, v_local,
+                                                    self.relative_pos_bias_local, self.learnable_tokens,
+                                                    self.learnable_bias)
+            x = pool_attn_triton(q_norm_scaled, k_pool, k_pool_inv, v_pool, relative_pos_bias, m, l, acc, x)
+            x = x.transpose(1, 2).reshape(B, N, C)
+        else:
+            attn_pool = q_norm_scaled @ (k_pool * k_pool_inv).transpose(-2, -1) + relative_pos_bias
 
+            k_local = local_window_view(k_local, self.window_size)
+            v_local = local_window_view(v_local, self.window_size)
+            q_img = q_norm_scaled.transpose(-2, -1).unflatten(-1, (H, W))
 
-        pool_bias = self.cpb_fc2(self.cpb_act(self.cpb_fc1(relative_coords_table))).transpose(0, 1)[:,
-                    relative_pos_index.view(-1)].view(-1, N, self.pool_len)
 
-        attn_pool = q_norm_scaled @ F.normalize(k_pool, dim=-1).transpose(-2, -1) + pool_bias
+            attn_local = torch.stack([(q_img * k_local[..., i, j]).sum(dim=2) for i in range(self.window_size)
+                                      for j in range(self.window_size)], dim=-1).flatten(2, 3)
+            attn_local = (attn_local + self.relative_pos_bias_local.unsqueeze(1)).masked_fill(self.padding_mask, float('-inf'))
 
 
-        attn = torch.cat([attn_local, attn_pool], dim=-1).softmax(dim=-1)
-        attn = self.attn_drop(attn)
+            attn = torch.cat([attn_local, attn_pool], dim=-1).softmax(dim=-1)
+            attn = self.attn_drop(attn)
 
 
-        attn_local, attn_pool = torch.split(attn, [self.local_len, self.pool_len], dim=-1)
-        x_local = (((q_norm @ self.learnable_tokens) + self.learnable_bias + attn_local).unsqueeze(-2) @ v_local.transpose(-2, -1)).squeeze(-2)
-        x_pool = attn_pool @ v_pool
-        x = (x_local + x_pool).transpose(1, 2).reshape(B, N, C)
+            attn_local, attn_pool = torch.split(attn, [self.local_len, self.pool_len], dim=-1)
+            attn_local = ((q_norm @ self.learnable_tokens) + self.learnable_bias + attn_local).unflatten(2, (H, W))
+            x_local = 0
+            for i in range(self.window_size):
+                for j in range(self.window_size):
+                    x_local = x_local + attn_local[..., i * self.window_size + j].unsqueeze(2) * v_local[..., i, j]
+            x_local = x_local.flatten(-2).transpose(-2, -1)
+            x_pool = attn_pool @ v_pool
+            x = (x_local + x_pool).transpose(1, 2).reshape(B, N, C)
 
 
         x = self.proj(x)
@@ -203,29 +641,32 @@ class Attention(nn.Module):
         self.query_embedding = nn.Parameter(
             nn.init.trunc_normal_(torch.empty(self.num_heads, 1, self.head_dim), mean=0, std=0.02))
 
-        self.attn_drop = nn.Dropout(attn_drop)
+        self.attn_drop = nn.Dropout(attn_drop) if attn_drop > 0. else nn.Identity()
         self.proj = nn.Linear(dim, dim)
-        self.proj_drop = nn.Dropout(proj_drop)
+        self.proj_drop = nn.Dropout(proj_drop) if proj_drop > 0. else nn.Identity()
 
 
         self.cpb_fc1 = nn.Linear(2, 512, bias=True)
         self.cpb_act = nn.ReLU(inplace=True)
         self.cpb_fc2 = nn.Linear(512, num_heads, bias=True)
+        self.register_buffer("cpb_bias_table", None, persistent=False)
+        self._cpb_bias_key = None
 
-    def forward(self, x, H, W, relative_pos_index, relative_coords_table):
+    def forward(self, x, H, W, relative_pos_bias):
         B, N, C = x.shape
         qkv = self.qkv(x).reshape(B, -1, 3 * self.num_heads, self.head_dim).permute(0, 2, 1, 3)
         q, k, v = qkv.chunk(3, dim=1)
 
 
-        rel_bias = self.cpb_fc2(self.cpb_act(self.cpb_fc1(relative_coords_table))).transpose(0, 1)[:,
-                   relative_pos_index.view(-1)].view(-1, N, N)
-
-
-        attn = ((F.normalize(q, dim=-1) + self.query_embedding) * F.softplus(self.temperature) * self.seq_length_scale) @ F.normalize(k, dim=-1).transpose(-2, -1) + rel_bias
-        attn = attn.softmax(dim=-1)
-        attn = self.attn_drop(attn)
-        x = (attn @ v).transpose(1, 2).reshape(B, N, C)
+        q = query_prelude(q, self.query_embedding, self.temperature, self.seq_length_scale)
+        k = F.normalize(k, dim=-1)
+        # an explicit 0 lets SDPA pick its dropout-free kernels
+        dropout_p = self.attn_drop.p if self.training and isinstance(self.attn_drop, nn.Dropout) else 0.
+        # normalize runs in fp32 under autocast, SDPA needs q, k, v and the bias in one dtype; the fused kernels
+        # only need a unit stride on head_dim, which the (B, heads, N, head_dim) views already have
+        x = F.scaled_dot_product_attention(q.to(v.dtype), k.to(v.dtype), v, attn_mask=relative_pos_bias.to(v.dtype),
+                                           dropout_p=dropout_p, scale=1.)
+        x = x.transpose(1, 2).reshape(B, N, C)
         x = self.proj(x)
         x = self.proj_drop(x)
         return x
@@ -235,7 +676,7 @@ class Block(nn.Module):
 
     def __init__(self, dim, num_heads, input_resolution, window_size=3, mlp_ratio=4.,
                  qkv_bias=False, drop=0., attn_drop=0.,
-                 drop_path=0., act_layer=nn.GELU, norm_layer=nn.LayerNorm, sr_ratio=1):
+                 drop_path=0., act_layer=nn.GELU, norm_layer=nn.LayerNorm, sr_ratio=1, dw_tap_sum=False):
         super().__init__()
         self.norm1 = norm_layer(dim)
         if sr_ratio == 1:
@@ -258,18 +699,35 @@ class Block(nn.Module):
                 sr_ratio=sr_ratio)
         self.norm2 = norm_layer(dim)
         mlp_hidden_dim = int(dim * mlp_ratio)
-        self.mlp = ConvolutionalGLU(in_features=dim, hidden_features=mlp_hidden_dim, act_layer=act_layer, drop=drop)
+        self.mlp = ConvolutionalGLU(in_features=dim, hidden_features=mlp_hidden_dim, act_layer=act_layer, drop=drop,
+                                    dw_tap_sum=dw_tap_sum)
 
 
         self.drop_path = DropPath(drop_path) if drop_path > 0. else nn.Identity()
 
-    def forward(self, x, H, W, relative_pos_index, relative_coords_table):
-        x = x + self.drop_path(self.attn(self.norm1(x), H, W, relative_pos_index, relative_coords_table))
+    def forward(self, x, H, W, relative_pos_bias):
+        if use_triton(x) and isinstance(self.norm2, nn.LayerNorm) and self.norm2.weight is not None \
+                and self.norm2.bias is not None:
+            # the first residual add is fused with norm2
+            attn = self.drop_path(self.attn(self.norm1(x), H, W, relative_pos_bias))
+            normed, x = add_layernorm_triton(attn, x, self.norm2.weight, self.norm2.bias, self.norm2.eps)
+            return x + self.drop_path(self.mlp(normed, H, W))
+
+        x = x + self.drop_path(self.attn(self.norm1(x), H, W, relative_pos_bias))
         x = x + self.drop_path(self.mlp(self.norm2(x), H, W))
 
         return x
 
 
+class BlockStage(nn.ModuleList):
+    # a ModuleList (state dict keys stay block{i}.{j}.*) that runs its blocks as one module call
+
+    def forward(self, x, H, W, relative_pos_bias):
+        for blk, rel_bias in zip(self, relative_pos_bias):
+            x = blk(x, H, W, rel_bias)
+        return x
+
+
 class OverlapPatchEmbed(nn.Module):
 
 
@@ -328,11 +786,14 @@ class TransNeXt(nn.Module):
                  patch_size=16, in_chans=1, num_classes=30, embed_dims=[64, 128, 256, 512],
                  num_heads=[1, 2, 4, 8], mlp_ratios=[4, 4, 4, 4], qkv_bias=False, drop_rate=0.,
                  attn_drop_rate=0., drop_path_rate=0., norm_layer=nn.LayerNorm,
-                 depths=[3, 4, 6, 3], sr_ratios=[8, 4, 2, 1], num_stages=4):
+                 depths=[3, 4, 6, 3], sr_ratios=[8, 4, 2, 1], num_stages=4, autocast_dtype=None,
+                 dw_tap_sum=False):
         super().__init__()
         self.num_classes = num_classes
         self.depths = depths
         self.num_stages = num_stages
+        # e.g. torch.bfloat16: run the forward under autocast, parameters stay fp32
+        self.autocast_dtype = autocast_dtype
         pretrain_size = pretrain_size or img_size
 
         dpr = [x.item() for x in torch.linspace(0, drop_path_rate, sum(depths))]
@@ -352,11 +813,11 @@ class TransNeXt(nn.Module):
                                             in_chans=in_chans if i == 0 else embed_dims[i - 1],
                                             embed_dim=embed_dims[i])
 
-            block = nn.ModuleList([Block(
+            block = BlockStage([Block(
                 dim=embed_dims[i], input_resolution=to_2tuple(img_size // (2 ** (i + 2))), window_size=window_size[i],
                 num_heads=num_heads[i], mlp_ratio=mlp_ratios[i], qkv_bias=qkv_bias,
                 drop=drop_rate, attn_drop=attn_drop_rate, drop_path=dpr[cur + j], norm_layer=norm_layer,
-                sr_ratio=sr_ratios[i])
+                sr_ratio=sr_ratios[i], dw_tap_sum=dw_tap_sum)
                 for j in range(depths[i])])
             norm = norm_layer(embed_dims[i])
             cur += depths[i]
@@ -367,13 +828,6 @@ class TransNeXt(nn.Module):
 
 
 
-        self.up0 = nn.Sequential(
-            nn.Upsample(scale_factor=4, mode='bilinear', align_corners=True),
-            nn.LeakyReLU(inplace=True)
-        )
-
-        self.outc = nn.Conv2d(embed_dims[0], 1, kernel_size=1, padding=0)
-
         self.segmentation_head = SegmentationHead(
             in_channels=embed_dims[0],
             out_channels=25,
@@ -392,6 +846,23 @@ class TransNeXt(nn.Module):
         for n, m in self.named_modules():
             self._init_weights(m, n)
 
+        self._rel_bias_cache = {}
+        self._graph = None
+
+        # NHWC lets cudnn pick its tensor-core conv kernels; only the 4D conv weights are affected
+        self.to(memory_format=torch.channels_last)
+
+    def train(self, mode=True):
+        # eval() always rebuilds the cpb caches, so weights changed in place through .data are picked up.
+        # A captured CUDA graph reads the cached bias tensors directly, so it is dropped along with them.
+        self._rel_bias_cache.clear()
+        for m in self.modules():
+            if hasattr(m, '_cpb_bias_key'):
+                m.cpb_bias_table = None
+                m._cpb_bias_key = None
+        self._graph = self._graph_input = self._graph_output = None
+        return super().train(mode)
+
     def _init_weights(self, m: nn.Module, name: str = ''):
         if isinstance(m, nn.Linear):
             trunc_normal_(m.weight, std=.02)
@@ -422,7 +893,26 @@ class TransNeXt(nn.Module):
         self.num_classes = num_classes
         self.head = nn.Linear(self.embed_dim, num_classes) if num_classes > 0 else nn.Identity()
 
-    def forward_features(self, x):
+    def get_relative_pos_bias(self, i):
+        # the cpb MLP output only changes with its weights: compute it once per block and forward, and under
+        # inference_mode keep it across calls until a cpb parameter is updated or moved
+        block = getattr(self, f"block{i + 1}")
+        relative_pos_index = getattr(self, f"relative_pos_index{i + 1}")
+        relative_coords_table = getattr(self, f"relative_coords_table{i + 1}")
+        if not torch.is_inference_mode_enabled():
+            return [relative_position_bias(blk.attn, relative_pos_index, relative_coords_table) for blk in block]
+
+        key = cpb_cache_key([blk.attn for blk in block], relative_coords_table)
+        cached = self._rel_bias_cache.get(i)
+        if cached is None or cached[0] != key:
+            cached = key, [relative_position_bias(blk.attn, relative_pos_index, relative_coords_table)
+                           for blk in block]
+            self._rel_bias_cache[i] = cached
+        return cached[1]
+
+    def forward_features(self, x, relative_pos_bias=None):
+        if relative_pos_bias is None:
+            relative_pos_bias = [self.get_relative_pos_bias(i) for i in range(self.num_stages)]
         B = x.shape[0]
         feature = []
         for i in range(self.num_stages):
@@ -430,17 +920,17 @@ class TransNeXt(nn.Module):
             block = getattr(self, f"block{i + 1}")
             norm = getattr(self, f"norm{i + 1}")
             x, H, W = patch_embed(x)
-            relative_pos_index = getattr(self, f"relative_pos_index{i + 1}")
-            relative_coords_table = getattr(self, f"relative_coords_table{i + 1}")
-            for blk in block:
-                x = blk(x, H, W, relative_pos_index, relative_coords_table)
+            x = block(x, H, W, relative_pos_bias[i])
             x = norm(x)
             # if i != self.num_stages - 1:
-            x = x.reshape(B, H, W, -1).permute(0, 3, 1, 2).contiguous()
+            # NHWC view with channels_last strides, no copy needed before the next conv
+            x = x.reshape(B, H, W, -1).permute(0, 3, 1, 2)
             feature.append(x)
         return x, feature
 
-    def up_features(self, x, features):
+    def up_features(self, x, features, relative_pos_bias=None):
+        if relative_pos_bias is None:
+            relative_pos_bias = [self.get_relative_pos_bias(i) for i in range(self.num_stages)]
         B = x.shape[0]
 
         for i in range(self.num_stages - 1):
@@ -452,23 +942,66 @@ class TransNeXt(nn.Module):
             norm_up = getattr(self, f"norm{3 - i}")
             _, _, H, W = x.shape
             x = x.flatten(2).transpose(1, 2)
-            relative_pos_index = getattr(self, f"relative_pos_index{3 - i}")
-            relative_coords_table = getattr(self, f"relative_coords_table{3 - i}")
-            for blk in block_up:
-                x = blk(x, H, W, relative_pos_index, relative_coords_table)
+            x = block_up(x, H, W, relative_pos_bias[2 - i])
             x = norm_up(x)
             # if i != self.num_stages - 1:
-            x = x.reshape(B, H, W, -1).permute(0, 3, 1, 2).contiguous()
+            x = x.reshape(B, H, W, -1).permute(0, 3, 1, 2)
 
         return x
 
 
     def forward(self, x):
-        x, features = self.forward_features(x)
-        x = self.up_features(x, features)
-        x = self.segmentation_head(x)
-
-        return x
+        dtype = x.dtype
+        x = x.contiguous(memory_format=torch.channels_last)
+        with torch.autocast(device_type=x.device.type, enabled=False):
+            relative_pos_bias = [self.get_relative_pos_bias(i) for i in range(self.num_stages)]
+
+        # without autocast_dtype, leave any autocast the caller has running untouched
+        if self.autocast_dtype is None:
+            autocast = contextlib.nullcontext()
+        else:
+            autocast = torch.autocast(device_type=x.device.type, dtype=self.autocast_dtype)
+        with autocast:
+            x, features = self.forward_features(x, relative_pos_bias)
+            x = self.up_features(x, features, relative_pos_bias)
+            x = self.segmentation_head(x)
+
+        return x if self.autocast_dtype is None else x.to(dtype)
+
+    def compile_stages(self, **compile_kwargs):
+        # torch.compile each BlockStage in place, collapsing the per-block Python loop; state dict keys are
+        # unchanged. Pass mode="reduce-overhead" for CUDA, the default mode suits CPU.
+        compile_kwargs.setdefault('dynamic', False)
+        for i in range(self.num_stages):
+            getattr(self, f"block{i + 1}").compile(**compile_kwargs)
+        return self
+
+    @torch.inference_mode()
+    def forward_graph(self, x):
+        # small-batch inference is launch bound: capture the whole forward in a CUDA graph once per input
+        # shape and replay it. The result is the graph's static output tensor, overwritten by the next call.
+        # The graph bakes in the cached cpb bias tensors: train()/eval() drop both, and the next call
+        # recaptures; set self._graph = None to recapture after changing the weights.
+        if not x.is_cuda:
+            return self(x)
+        if self._graph is None or self._graph_input.shape != x.shape or self._graph_input.dtype != x.dtype \
+                or self._graph_input.device != x.device:
+            self._graph_input = x.clone(memory_format=torch.channels_last)
+            stream = torch.cuda.Stream(device=x.device)
+            stream.wait_stream(torch.cuda.current_stream(x.device))
+            with torch.cuda.stream(stream):
+                # warm-up also compiles the triton kernels and fills the cpb bias cache
+                for _ in range(3):
+                    self(self._graph_input)
+            torch.cuda.current_stream(x.device).wait_stream(stream)
+
+            self._graph = torch.cuda.CUDAGraph()
+            with torch.cuda.graph(self._graph):
+                self._graph_output = self(self._graph_input)
+
+        self._graph_input.copy_(x)
+        self._graph.replay()
+        return self._graph_output
 
 
 @register_model
@@ -482,7 +1015,15 @@ def transnext_micro(pretrained=False, **kwargs):
     return model
 
 
-Input = torch.randn(1, 1, 256, 256)
-model = transnext_micro()
-output = model(Input)
-print(output.size())
+def quantize_dynamic_cpu(model, layers=('fc1', 'fc2', 'proj', 'cpb_fc1', 'cpb_fc2')):
+    # int8 dynamic quantization (FBGEMM / oneDNN) of a CPU model for inference; only the MLP, output
+    # projection and cpb Linears are converted, q / kv / qkv feed the attention scores and stay fp32
+    names = {n for n, m in model.named_modules() if isinstance(m, nn.Linear) and n.rsplit('.', 1)[-1] in layers}
+    return torch.ao.quantization.quantize_dynamic(model, names, dtype=torch.qint8).eval()
+
+
+if __name__ == '__main__':
+    Input = torch.randn(1, 1, 256, 256)
+    model = transnext_micro()
+    output = model(Input)
+    print(output.size())